@@ -1,4 +1,107 @@
 import numpy as np
+import math
+from numba import njit
+
+""" Horner coefficients (highest degree first) of the 4 cubic B-spline lobes and of their 1st derivative over tb in [0,1) """
+_B3_COEFS = np.array([[-1./6,  .5, -.5, 1./6],
+                      [   .5, -1.,  0., 2./3],
+                      [  -.5,  .5,  .5, 1./6],
+                      [ 1./6,  0.,  0.,   0.]])
+_DB3_COEFS = np.array([[ -.5,  1., -.5],
+                       [ 1.5, -2.,  0.],
+                       [-1.5,  1.,  .5],
+                       [  .5,  0.,  0.]])
+
+""" Cubic B-spline basis at the normalized coordinate tb in [0,1) """
+@njit(cache=True, inline='always')
+def _spline_basis(tb):
+    c = _B3_COEFS
+    return (((c[0,0]*tb + c[0,1])*tb + c[0,2])*tb + c[0,3],
+            ((c[1,0]*tb + c[1,1])*tb + c[1,2])*tb + c[1,3],
+            ((c[2,0]*tb + c[2,1])*tb + c[2,2])*tb + c[2,3],
+            ((c[3,0]*tb + c[3,1])*tb + c[3,2])*tb + c[3,3])
+
+""" 1st derivative of the cubic B-spline basis at the normalized coordinate tb in [0,1) """
+@njit(cache=True, inline='always')
+def _spline_basis_derivative(tb, inv_knot_space):
+    c = _DB3_COEFS
+    return (((c[0,0]*tb + c[0,1])*tb + c[0,2]) * inv_knot_space,
+            ((c[1,0]*tb + c[1,1])*tb + c[1,2]) * inv_knot_space,
+            ((c[2,0]*tb + c[2,1])*tb + c[2,2]) * inv_knot_space,
+            ((c[3,0]*tb + c[3,1])*tb + c[3,2]) * inv_knot_space)
+
+""" Evaluate the cubic B-spline basis (and its 1st derivative) over [n] coordinates
+    Fills b_out [nx4] if ORDER & 0x01 and db_out [nx4] if ORDER & 0x02
+"""
+@njit(cache=True, fastmath=True)
+def _compute_spline_njit(tau, origin, knot_space, ORDER, b_out, db_out):
+    inv_knot_space = 1./knot_space
+    for i in range(tau.size):
+        tb = (tau[i]*inv_knot_space + origin) % 1
+        if ORDER & 0x01:
+            b_out[i, 0], b_out[i, 1], b_out[i, 2], b_out[i, 3] = _spline_basis(tb)
+        if ORDER & 0x02:
+            db_out[i, 0], db_out[i, 1], db_out[i, 2], db_out[i, 3] = _spline_basis_derivative(tb, inv_knot_space)
+
+""" Evaluate the bicubic tensor basis (and its partial derivatives) over a [2xn] array of points
+    Fills B [nx16] if ORDER & 0x01 and dBx, dBy [nx16] if ORDER & 0x02
+"""
+@njit(cache=True, fastmath=True)
+def _tensor_spline_njit(pts, gcx, gcy, knot_space, ORDER, B, dBx, dBy):
+    inv_knot_space = 1./knot_space
+    for p in range(pts.shape[1]):
+        tbx = (pts[0, p]*inv_knot_space + gcx) % 1
+        tby = (pts[1, p]*inv_knot_space + gcy) % 1
+        bx = _spline_basis(tbx)
+        by = _spline_basis(tby)
+        if ORDER & 0x01:
+            for i in range(4):
+                for j in range(4):
+                    B[p, 4*i+j] = by[i]*bx[j]
+        if ORDER & 0x02:
+            dbx = _spline_basis_derivative(tbx, inv_knot_space)
+            dby = _spline_basis_derivative(tby, inv_knot_space)
+            for i in range(4):
+                for j in range(4):
+                    dBx[p, 4*i+j] = by[i]*dbx[j]
+                    dBy[p, 4*i+j] = dby[i]*bx[j]
+
+""" Compute the 16 sparse tensor indices of the control points supporting each point of a [2xn] array """
+@njit(cache=True)
+def _sparse_tensor_index_njit(pts, gcx, gcy, gs0, knot_space, degree, out):
+    for p in range(pts.shape[1]):
+        mux = -math.ceil(-pts[0, p]/knot_space) + gcx
+        muy = -math.ceil(-pts[1, p]/knot_space) + gcy
+        for i in range(4):
+            for j in range(4):
+                out[p, 4*i+j] = (muy - degree + i)*gs0 + (mux - degree + j)
+
+""" Compute the sparse tensor index c_out [nx16], the bicubic tensor basis B_out [nx16] and
+    the surface value s_out [n] of a [2xn] array of points in a single pass
+    Returns the number of points whose support falls outside the map (their outputs are left untouched)
+"""
+@njit(cache=True, fastmath=True)
+def _sparse_tensor_spline_njit(pts, ctrl_pts, gcx, gcy, gs0, knot_space, c_out, B_out, s_out):
+    inv_knot_space = 1./knot_space
+    nb_outside = 0
+    for p in range(pts.shape[1]):
+        mux = -math.ceil(-pts[0, p]/knot_space) + gcx
+        muy = -math.ceil(-pts[1, p]/knot_space) + gcy
+        if mux < 3 or mux >= gs0 or muy < 3 or muy >= ctrl_pts.size//gs0:
+            nb_outside += 1
+            continue
+        bx = _spline_basis((pts[0, p]*inv_knot_space + gcx) % 1)
+        by = _spline_basis((pts[1, p]*inv_knot_space + gcy) % 1)
+        s = 0.
+        for i in range(4):
+            for j in range(4):
+                c = (muy - 3 + i)*gs0 + (mux - 3 + j)
+                b = by[i]*bx[j]
+                c_out[p, 4*i+j] = c
+                B_out[p, 4*i+j] = b
+                s += ctrl_pts[c]*b
+        s_out[p] = s
+    return nb_outside
 
 class CubicSplineSurface:
     def __init__(self, **kwargs):
@@ -11,7 +114,7 @@ class CubicSplineSurface:
         self.knot_space = knot_space
         self.grid_size = np.ceil(surface_size/knot_space+self.degree).astype(int).reshape([2,1]) 
         self.grid_center = np.ceil((self.grid_size-self.degree)/2).reshape(2,1) + self.degree - 1  
-        self.ctrl_pts =  np.ones((self.grid_size[0,0], self.grid_size[1,0]) ).flatten()
+        self.ctrl_pts =  np.ones((self.grid_size[0,0], self.grid_size[1,0]), dtype=np.float32).flatten()
 
         # Bounds
         self.map_lower_limits = (self.degree - self.grid_center)*self.knot_space
@@ -27,45 +130,54 @@ class CubicSplineSurface:
 
     """ Compute spline tensor coefficient index associated to the sparse representation """
     def compute_sparse_tensor_index(self, pts):
-        # Compute spline along each axis
-        cx = self.compute_sparse_spline_index(pts[0,:], self.grid_center[0,0])
-        cy = self.compute_sparse_spline_index(pts[1,:], self.grid_center[1,0])
-
-        # Kronecker product for index
-        c = np.zeros([cx.shape[0],(self.degree+1)**2],dtype='int')
-        for i in range(0, self.degree+1):
-            for j in range(0, self.degree+1):
-                c[:,i*(self.degree+1)+j] = cy[:,i]*(self.grid_size[0,0])+cx[:,j]
+        c = np.empty([pts.shape[1],(self.degree+1)**2],dtype=np.int32)
+        _sparse_tensor_index_njit(np.asarray(pts, dtype=np.float64), 
+                                  int(self.grid_center[0,0]), 
+                                  int(self.grid_center[1,0]), 
+                                  int(self.grid_size[0,0]), 
+                                  float(self.knot_space), 
+                                  self.degree, c)
         return c
 
+    """ Compute sparse tensor index, spline tensor and spline surface value of a [2xn] array of points """
+    def compute_sparse_tensor_spline(self, pts):
+        nb_pts = pts.shape[1]
+        c = np.empty([nb_pts,(self.degree+1)**2],dtype=np.int32)
+        B = np.empty([nb_pts,(self.degree+1)**2])
+        s = np.empty(nb_pts)
+        nb_outside = _sparse_tensor_spline_njit(np.asarray(pts, dtype=np.float64), 
+                                                self.ctrl_pts, 
+                                                int(self.grid_center[0,0]), 
+                                                int(self.grid_center[1,0]), 
+                                                int(self.grid_size[0,0]), 
+                                                float(self.knot_space), 
+                                                c, B, s)
+        if nb_outside:
+            raise IndexError('[basics.cubic_spline_surface] %d point(s) outside the map' % nb_outside)
+        return c, B, s
+
     """"Compute spline coefficients up to order 2 """
     def compute_sparse_tensor_coefficents(self, tau, origin, ORDER=0x01):
         nb_pts = len(tau)
-        tau_bar = (tau/self.knot_space + origin) % 1 
-        tau_3 = tau_bar + 3
-        tau_2 = tau_bar + 2        
-        tau_1 = tau_bar + 1
-        tau_0 = tau_bar
-        
-        # Spline
+        tau = np.asarray(tau, dtype=np.float64)
+
+        # Spline and 1st derivative of spline
         b = db = dbb = []
+        b_out = np.empty([nb_pts if ORDER & 0x01 else 0, self.degree+1])
+        db_out = np.empty([nb_pts if ORDER & 0x02 else 0, self.degree+1])
+        _compute_spline_njit(tau, float(origin), float(self.knot_space), ORDER, b_out, db_out)
         if ORDER & 0x01:
-            b = np.zeros([nb_pts,self.degree+1])
-            b[:,0] = (1./6)*(-tau_3**3 + 12*tau_3**2 - 48*tau_3 + 64) 
-            b[:,1] = (1./6)*(3*tau_2**3 - 24*tau_2**2 + 60*tau_2 - 44)
-            b[:,2] = (1./6)*(-3*tau_1**3 + 12*tau_1**2 - 12*tau_1 + 4)
-            b[:,3] = (1./6)*(tau_0**3)
-
-        # 1st derivative of spline
+            b = b_out
         if ORDER & 0x02:
-            db = np.zeros([nb_pts,self.degree+1])
-            db[:,0] = (1./6)*(-3*tau_3**2 + 24*tau_3 - 48 ) * (1./self.knot_space) 
-            db[:,1] = (1./6)*(9*tau_2**2 - 48*tau_2 + 60 ) * (1./self.knot_space)
-            db[:,2] = (1./6)*(-9*tau_1**2 + 24*tau_1 - 12) * (1./self.knot_space)
-            db[:,3] = (1./6)*(3*tau_0**2) * (1./self.knot_space)
+            db = db_out
 
         # 2nd derivative of spline
         if ORDER & 0x04:
+            tau_bar = (tau/self.knot_space + origin) % 1 
+            tau_3 = tau_bar + 3
+            tau_2 = tau_bar + 2        
+            tau_1 = tau_bar + 1
+            tau_0 = tau_bar
             ddb = np.zeros([nb_pts,self.degree+1])
             ddb[:,0] = (1./6)*(-6*tau_3 + 24) * (1./self.knot_space**2)
             ddb[:,1] = (1./6)*(18*tau_2 - 48) * (1./self.knot_space**2)
@@ -79,26 +191,19 @@ class CubicSplineSurface:
         # Storing number of points
         nb_pts = pts.shape[1]
 
-        # Compute spline along each axis
-        bx, dbx, _ = self.compute_sparse_tensor_coefficents(pts[0,:], self.grid_center[0,0], ORDER | 0x01)
-        by, dby, _ = self.compute_sparse_tensor_coefficents(pts[1,:], self.grid_center[1,0], ORDER | 0x01)
-
         # Compute spline tensor
         B = dBx = dBy = []
+        B_out = np.empty([nb_pts if ORDER & 0x01 else 0, (self.degree+1)**2])
+        dBx_out = np.empty([nb_pts if ORDER & 0x02 else 0, (self.degree+1)**2])
+        dBy_out = np.empty([nb_pts if ORDER & 0x02 else 0, (self.degree+1)**2])
+        _tensor_spline_njit(np.asarray(pts, dtype=np.float64), 
+                            float(self.grid_center[0,0]), 
+                            float(self.grid_center[1,0]), 
+                            float(self.knot_space), 
+                            ORDER, B_out, dBx_out, dBy_out)
         if ORDER & 0x01:
-            B = np.zeros([nb_pts,(self.degree+1)**2])
-            for i in range(0,self.degree+1):
-                for j in range(0,self.degree+1):           
-                    B[:,i*(self.degree+1)+j] = by[:,i]*bx[:,j]
-
-
+            B = B_out
         if ORDER & 0x02:
-            dBx = np.zeros([nb_pts,(self.degree+1)**2])
-            dBy = np.zeros([nb_pts,(self.degree+1)**2])        
-            for i in range(0,self.degree+1):
-                for j in range(0,self.degree+1):           
-                    dBx[:,i*(self.degree+1)+j] = by[:,i]*dbx[:,j]
-                    dBy[:,i*(self.degree+1)+j] = dby[:,i]*bx[:,j]
-            return B, dBx, dBy
-
-        return B, dBx, dBy
\ No newline at end of file
+            dBx, dBy = dBx_out, dBy_out
+
+        return B, dBx, dBy
@@ -3,6 +3,48 @@ import math
 import time
 import random
 import scipy.sparse.linalg
+from numba import njit
+
+""" Accumulate ctrl_pts[c_index[p,k]] += B[p,k]*mag[p], repeated indices included (same as np.add.at) """
+@njit(cache=True, fastmath=True)
+def _scatter_njit(ctrl_pts, c_index, B, mag):
+    for p in range(c_index.shape[0]):
+        m = mag[p]
+        for k in range(c_index.shape[1]):
+            ctrl_pts[c_index[p, k]] += B[p, k]*m
+
+""" Add value once to each distinct ctrl_pts[c_index] (same as ctrl_pts[c_index] += value)
+    mask [ctrl_pts.size] marks the visited indices and is left cleared
+    Returns the number of indices outside ctrl_pts, in which case ctrl_pts is left untouched
+"""
+@njit(cache=True)
+def _add_once_njit(ctrl_pts, c_index, value, mask):
+    nb_outside = 0
+    for p in range(c_index.shape[0]):
+        for k in range(c_index.shape[1]):
+            c = c_index[p, k]
+            if c < 0 or c >= ctrl_pts.size:
+                nb_outside += 1
+    if nb_outside:
+        return nb_outside
+    for p in range(c_index.shape[0]):
+        for k in range(c_index.shape[1]):
+            c = c_index[p, k]
+            if not mask[c]:
+                mask[c] = True
+                ctrl_pts[c] += value
+    for p in range(c_index.shape[0]):
+        for k in range(c_index.shape[1]):
+            mask[c_index[p, k]] = False
+    return 0
+
+""" Clamp ctrl_pts[c_index] to [lower, upper] in place """
+@njit(cache=True)
+def _clamp_njit(ctrl_pts, c_index, lower, upper):
+    for p in range(c_index.shape[0]):
+        for k in range(c_index.shape[1]):
+            c = c_index[p, k]
+            ctrl_pts[c] = min(max(ctrl_pts[c], lower), upper)
 
 class Mapping:
     def __init__(self, spline_map, **kwargs):
@@ -20,29 +62,28 @@ class Mapping:
         self.logodd_free = logodd_free
         self.logodd_min_free = logodd_min_free
         self.logodd_max_occupied = logodd_max_occupied
+        self.ctrl_pts_mask = np.zeros(self.map.ctrl_pts.size, dtype=bool)
 
         self.time = np.zeros(5)           
   
-    """ Transform an [2xn] array of (x,y) coordinates to the global frame
+    """ Transform an [2xn] array (or (x, y) tuple of arrays) of coordinates to the global frame
         Input: pose np.array<float(3,1)> describes (x,y,theta)'
     """
     def local_to_global_frame(self, pose, local):
         c, s = np.cos(pose[2]), np.sin(pose[2])
-        R = np.array([[c, -s],[s, c]])
-        return np.matmul(R, local) + pose[0:2].reshape(2,1) 
+        return np.stack([c*local[0] - s*local[1] + pose[0], s*local[0] + c*local[1] + pose[1]])
 
     """"Update the control points of the spline map"""
     def update_spline_map(self, pts_occ, pts_free, pose):
         # Free space 
         c_index_free = self.map.compute_sparse_tensor_index(pts_free)
-        c_index_occ = self.map.compute_sparse_tensor_index(pts_occ)
-
-        B_occ, _, _ = self.map.compute_tensor_spline(pts_occ, ORDER=0x01)
-        s_est_occ_ant = np.sum(self.map.ctrl_pts[c_index_occ]*B_occ, axis=1)
+        c_index_occ, B_occ, s_est_occ_ant = self.map.compute_sparse_tensor_spline(pts_occ)
 
         # Free space
-        self.map.ctrl_pts[c_index_free] -= self.logodd_free
-        self.map.ctrl_pts[c_index_occ] += .5*self.logodd_free
+        if _add_once_njit(self.map.ctrl_pts, c_index_free, -self.logodd_free, self.ctrl_pts_mask):
+            raise IndexError('[core.mapping] Free space point(s) outside the map')
+        # c_index_occ is always inside the map, compute_sparse_tensor_spline raises otherwise
+        _add_once_njit(self.map.ctrl_pts, c_index_occ, .5*self.logodd_free, self.ctrl_pts_mask)
 
         # Occupied space [SLOW]
         # for i in range(0, pts_occ.shape[1]):
@@ -59,16 +100,14 @@ class Mapping:
         B_occ_norm = np.linalg.norm(B_occ, axis=1)
         B_occ_norm_squared = B_occ_norm**2
         mag_occ =  np.minimum(self.logodd_occupied/B_occ_norm_squared, np.abs(e_occ)) * np.sign(e_occ)
-        np.add.at(self.map.ctrl_pts, c_index_occ, (B_occ.T*mag_occ).T)        
+        _scatter_njit(self.map.ctrl_pts, c_index_occ, B_occ, mag_occ)
 
         # Clamping control points 
-        self.map.ctrl_pts[c_index_free] = np.maximum(np.minimum(self.map.ctrl_pts[c_index_free], self.logodd_max_occupied), self.logodd_min_free)
+        _clamp_njit(self.map.ctrl_pts, c_index_free, self.logodd_min_free, self.logodd_max_occupied)
 
     """ Evaluata map """
     def evaluate_map(self, pts):
-        B, _, _ = self.map.compute_tensor_spline(pts)
-        c_index = self.map.compute_sparse_tensor_index(pts)
-        s = np.sum(self.map.ctrl_pts[c_index]*B, axis=1)
+        _, _, s = self.map.compute_sparse_tensor_spline(pts)
         return s
 
     """"Occupancy grid mapping routine to update map using range measurements"""
@@ -1,7 +1,231 @@
 import numpy as np
 import math
 import time
-from scipy.optimize import least_squares
+from numba import njit, prange
+from spline_slam.basics.cubic_spline_surface import _spline_basis, _spline_basis_derivative
+
+""" Evaluate the spline surface s and its gradient (ds_x, ds_y) at the point (ux, uy) normalized by the knot space
+    Also returns the base sparse tensor index of the point (-1 for points outside the map, which do not contribute)
+"""
+@njit(cache=True, inline='always')
+def _spline_eval(ux, uy, ctrl_pts, gcx, gcy, gs0, inv_knot_space):
+    # Sparse tensor index
+    mux = -math.ceil(-ux) + gcx
+    muy = -math.ceil(-uy) + gcy
+    if mux < 3 or mux >= gs0 or muy < 3 or muy >= ctrl_pts.size//gs0:
+        return 0., 0., 0., -1
+    base = (muy - 3)*gs0 + (mux - 3)
+    # Spline basis and its derivative
+    tbx = (ux + gcx) % 1
+    tby = (uy + gcy) % 1
+    bx = _spline_basis(tbx)
+    by = _spline_basis(tby)
+    dbx = _spline_basis_derivative(tbx, inv_knot_space)
+    dby = _spline_basis_derivative(tby, inv_knot_space)
+    # Spline surface and its gradient
+    s = 0.
+    ds_x = 0.
+    ds_y = 0.
+    for i in range(4):
+        row_b = 0.
+        row_db = 0.
+        for j in range(4):
+            ctrl = ctrl_pts[base + i*gs0 + j]
+            row_b += ctrl*bx[j]
+            row_db += ctrl*dbx[j]
+        s += by[i]*row_b
+        ds_x += by[i]*row_db
+        ds_y += dby[i]*row_b
+    return s, ds_x, ds_y, base
+
+""" Scan-matching residual r = 1 - s/logodd_max_occupied [n] and its jacobian [nx3] of the occupied points (x_loc, y_loc) at pose
+    Fills r_out if ORDER & 0x01 and h_out if ORDER & 0x02, sharing the spline evaluation in a single pass
+"""
+@njit(cache=True, fastmath=True, parallel=True)
+def _residual_njit(pose, x_loc, y_loc, ctrl_pts, gcx, gcy, gs0, knot_space, inv_logodd, ORDER, r_out, h_out):
+    c, s = math.cos(pose[2]), math.sin(pose[2])
+    inv_knot_space = 1./knot_space
+    for p in prange(x_loc.size):
+        # Transforming to global frame (normalized by the knot space)
+        ux = (c*x_loc[p] - s*y_loc[p] + pose[0])*inv_knot_space
+        uy = (s*x_loc[p] + c*y_loc[p] + pose[1])*inv_knot_space
+        s_occ, ds_x, ds_y, _ = _spline_eval(ux, uy, ctrl_pts, gcx, gcy, gs0, inv_knot_space)
+        if ORDER & 0x01:
+            r_out[p] = 1. - s_occ*inv_logodd
+        if ORDER & 0x02:
+            ds_x *= inv_logodd
+            ds_y *= inv_logodd
+            h_out[p, 0] = -ds_x
+            h_out[p, 1] = -ds_y
+            h_out[p, 2] = -((-s*x_loc[p] - c*y_loc[p])*ds_x + (c*x_loc[p] - s*y_loc[p])*ds_y)
+
+""" Accumulate cost .5*r'r, the 6 unique entries of H = J'J and g = J'r in a single pass over the points """
+@njit(cache=True, fastmath=True, parallel=True, nogil=True)
+def _normal_equations_njit(pose, x_loc, y_loc, ctrl_pts, gcx, gcy, gs0, knot_space, inv_logodd):
+    c, s = math.cos(pose[2]), math.sin(pose[2])
+    inv_knot_space = 1./knot_space
+    cost = 0.
+    h00 = h01 = h02 = h11 = h12 = h22 = 0.
+    g0 = g1 = g2 = 0.
+    for p in prange(x_loc.size):
+        ux = (c*x_loc[p] - s*y_loc[p] + pose[0])*inv_knot_space
+        uy = (s*x_loc[p] + c*y_loc[p] + pose[1])*inv_knot_space
+        s_occ, ds_x, ds_y, _ = _spline_eval(ux, uy, ctrl_pts, gcx, gcy, gs0, inv_knot_space)
+        r = 1. - s_occ*inv_logodd
+        j0 = -ds_x*inv_logodd
+        j1 = -ds_y*inv_logodd
+        j2 = -((-s*x_loc[p] - c*y_loc[p])*ds_x + (c*x_loc[p] - s*y_loc[p])*ds_y)*inv_logodd
+        cost += r*r
+        h00 += j0*j0
+        h01 += j0*j1
+        h02 += j0*j2
+        h11 += j1*j1
+        h12 += j1*j2
+        h22 += j2*j2
+        g0 += j0*r
+        g1 += j1*r
+        g2 += j2*r
+    return .5*cost, h00, h01, h02, h11, h12, h22, g0, g1, g2
+
+""" Solve the symmetric 3x3 system A x = b by Cramer's rule. Returns False if A is singular """
+@njit(cache=True, inline='always')
+def _solve_sym3(a00, a01, a02, a11, a12, a22, b0, b1, b2):
+    c00 = a11*a22 - a12*a12
+    c01 = a02*a12 - a01*a22
+    c02 = a01*a12 - a02*a11
+    det = a00*c00 + a01*c01 + a02*c02
+    if det <= 0.:
+        return False, 0., 0., 0.
+    inv_det = 1./det
+    c11 = a00*a22 - a02*a02
+    c12 = a01*a02 - a00*a12
+    c22 = a00*a11 - a01*a01
+    return True, (c00*b0 + c01*b1 + c02*b2)*inv_det, (c01*b0 + c11*b1 + c12*b2)*inv_det, (c02*b0 + c12*b1 + c22*b2)*inv_det
+
+""" Levenberg-Marquardt parameter (MINPACK lmpar): find par such that the step p solving (H + par*D^2) p = -g
+    satisfies ||D p|| ~ delta > 0. Returns par = 0 with the Gauss-Newton step if it lies within the trust region,
+    and a zero step if the damped system is singular
+"""
+@njit(cache=True)
+def _lm_parameter(h00, h01, h02, h11, h12, h22, g0, g1, g2, d0, d1, d2, delta, par):
+    # Gauss-Newton step and lower bound of par
+    parl = 0.
+    ok, p0, p1, p2 = _solve_sym3(h00, h01, h02, h11, h12, h22, -g0, -g1, -g2)
+    if ok:
+        dxnorm = math.sqrt((d0*p0)**2 + (d1*p1)**2 + (d2*p2)**2)
+        fp = dxnorm - delta
+        if fp <= .1*delta:
+            return 0., p0, p1, p2
+        w0, w1, w2 = d0*d0*p0, d1*d1*p1, d2*d2*p2
+        ok, q0, q1, q2 = _solve_sym3(h00, h01, h02, h11, h12, h22, w0, w1, w2)
+        if ok and w0*q0 + w1*q1 + w2*q2 > 0.:
+            parl = fp/delta*dxnorm*dxnorm/(w0*q0 + w1*q1 + w2*q2)
+    # Upper bound of par
+    paru = math.sqrt((g0/d0)**2 + (g1/d1)**2 + (g2/d2)**2)/delta
+    if paru == 0.:
+        paru = 1e-300/min(delta, .1)
+    par = min(max(par, parl), paru)
+    # Safeguarded Newton iterations on ||D p(par)|| = delta
+    fp_previous = 0.
+    for iteration in range(10):
+        if par == 0.:
+            par = max(1e-300, 1e-3*paru)
+        a00, a11, a22 = h00 + par*d0*d0, h11 + par*d1*d1, h22 + par*d2*d2
+        ok, p0, p1, p2 = _solve_sym3(a00, h01, h02, a11, h12, a22, -g0, -g1, -g2)
+        if not ok:
+            return par, 0., 0., 0.
+        dxnorm = math.sqrt((d0*p0)**2 + (d1*p1)**2 + (d2*p2)**2)
+        fp = dxnorm - delta
+        if abs(fp) <= .1*delta or (parl == 0. and fp <= fp_previous and fp_previous < 0.) or iteration == 9:
+            break
+        fp_previous = fp
+        w0, w1, w2 = d0*d0*p0, d1*d1*p1, d2*d2*p2
+        ok, q0, q1, q2 = _solve_sym3(a00, h01, h02, a11, h12, a22, w0, w1, w2)
+        parc = 0.
+        if ok and w0*q0 + w1*q1 + w2*q2 > 0.:
+            parc = fp/delta*dxnorm*dxnorm/(w0*q0 + w1*q1 + w2*q2)
+        if fp > 0.:
+            parl = max(parl, par)
+        elif fp < 0.:
+            paru = min(paru, par)
+        par = max(parl, par + parc)
+    return par, p0, p1, p2
+
+""" Levenberg-Marquardt pose estimation (MINPACK lmder trust-region strategy on the 3x3 normal equations)
+    Stops when both the actual and predicted relative cost reduction are below ftol, when the trust region
+    is below xtol relative to the pose, when g is orthogonal to the columns of J, when no step can be taken
+    (zero step or trust region) or after max_nfev cost evaluations
+"""
+@njit(cache=True, nogil=True)
+def _pose_lm_njit(pose0, x_loc, y_loc, ctrl_pts, gcx, gcy, gs0, knot_space, inv_logodd, ftol, xtol, max_nfev):
+    # Current and trial poses are allocated once and swapped on accepted steps
+    pose = pose0.copy()
+    pose_new = np.empty(3)
+    cost, h00, h01, h02, h11, h12, h22, g0, g1, g2 = _normal_equations_njit(pose, x_loc, y_loc, ctrl_pts, gcx, gcy, gs0, knot_space, inv_logodd)
+    nfev = 1
+    fnorm = math.sqrt(2.*cost)
+    # Column scaling D = ||J_j|| and initial trust region
+    d0 = math.sqrt(h00) if h00 > 0. else 1.
+    d1 = math.sqrt(h11) if h11 > 0. else 1.
+    d2 = math.sqrt(h22) if h22 > 0. else 1.
+    xnorm = math.sqrt((d0*pose[0])**2 + (d1*pose[1])**2 + (d2*pose[2])**2)
+    delta = 100.*xnorm if xnorm > 0. else 100.
+    par = 0.
+    first = True
+    while nfev < max_nfev and fnorm > 0.:
+        # Gradient orthogonal to the columns of the jacobian
+        if max(abs(g0)/math.sqrt(h00) if h00 > 0. else 0., 
+               abs(g1)/math.sqrt(h11) if h11 > 0. else 0., 
+               abs(g2)/math.sqrt(h22) if h22 > 0. else 0.) <= 1e-8*fnorm:
+            return pose, cost
+        d0 = max(d0, math.sqrt(h00))
+        d1 = max(d1, math.sqrt(h11))
+        d2 = max(d2, math.sqrt(h22))
+        while True:
+            par, p0, p1, p2 = _lm_parameter(h00, h01, h02, h11, h12, h22, g0, g1, g2, d0, d1, d2, delta, par)
+            pnorm = math.sqrt((d0*p0)**2 + (d1*p1)**2 + (d2*p2)**2)
+            if first:
+                delta = min(delta, pnorm)
+                first = False
+            if pnorm == 0. or delta == 0.:
+                return pose, cost
+            pose_new[0] = pose[0] + p0
+            pose_new[1] = pose[1] + p1
+            pose_new[2] = pose[2] + p2
+            cost_new, n00, n01, n02, n11, n12, n22, m0, m1, m2 = _normal_equations_njit(pose_new, x_loc, y_loc, ctrl_pts, gcx, gcy, gs0, knot_space, inv_logodd)
+            nfev += 1
+            fnorm_new = math.sqrt(2.*cost_new)
+            # Actual and predicted relative reductions of the residual norm
+            actred = 1. - (fnorm_new/fnorm)**2 if .1*fnorm_new < fnorm else -1.
+            jp2 = h00*p0*p0 + h11*p1*p1 + h22*p2*p2 + 2.*(h01*p0*p1 + h02*p0*p2 + h12*p1*p2)
+            temp1 = jp2/(fnorm*fnorm)
+            temp2 = par*pnorm*pnorm/(fnorm*fnorm)
+            prered = temp1 + 2.*temp2
+            dirder = -(temp1 + temp2)
+            ratio = actred/prered if prered != 0. else 0.
+            # Update the trust region
+            if ratio <= .25:
+                temp = .5 if actred >= 0. else .5*dirder/(dirder + .5*actred)
+                if .1*fnorm_new >= fnorm or temp < .1:
+                    temp = .1
+                delta = temp*min(delta, pnorm/.1)
+                par = par/temp
+            elif par == 0. or ratio >= .75:
+                delta = pnorm/.5
+                par = .5*par
+            # Accept the step
+            accepted = ratio >= 1e-4
+            if accepted:
+                pose, pose_new = pose_new, pose
+                cost, fnorm = cost_new, fnorm_new
+                h00, h01, h02, h11, h12, h22, g0, g1, g2 = n00, n01, n02, n11, n12, n22, m0, m1, m2
+                xnorm = math.sqrt((d0*pose[0])**2 + (d1*pose[1])**2 + (d2*pose[2])**2)
+            # Convergence tests
+            if (abs(actred) <= ftol and prered <= ftol and .5*ratio <= 1.) or delta <= xtol*xnorm:
+                return pose, cost
+            if nfev >= max_nfev or accepted:
+                break
+    return pose, cost
 
 class ScanMatching:
     def __init__(self, spline_map, **kwargs): 
@@ -9,6 +233,7 @@ class ScanMatching:
         logodd_min_free = kwargs['logodd_min_free'] if 'logodd_min_free' in kwargs else -100
         logodd_max_occupied = kwargs['logodd_max_occupied'] if 'logodd_max_occupied' in kwargs else 100
         nb_iteration_max = kwargs['nb_iteration_max'] if 'nb_iteration_max' in kwargs else 10
+        sensor_subsampling_factor = kwargs['sensor_subsampling_factor'] if 'sensor_subsampling_factor' in kwargs else 4
 
         # LogOdd Map parameters
         self.map = spline_map
@@ -17,90 +242,66 @@ class ScanMatching:
 
         # Localization parameters
         self.nb_iteration_max = nb_iteration_max        
+        self.sensor_subsampling_factor = sensor_subsampling_factor
         self.pose = np.zeros(3)
         
         # Time
         self.time = np.zeros(3)  
 
 
-    """ Transform an [2xn] array of (x,y) coordinates to the global frame
+    """ Transform an [2xn] array (or (x, y) tuple of arrays) of coordinates to the global frame
         Input: pose np.array<float(3,1)> describes (x,y,theta)'
     """
     def local_to_global_frame(self, pose, local):
         c, s = np.cos(pose[2]), np.sin(pose[2])
-        R = np.array([[c, -s],[s, c]])
-        return np.matmul(R, local) + pose[0:2].reshape(2,1)
+        return np.stack([c*local[0] - s*local[1] + pose[0], s*local[0] + c*local[1] + pose[1]])
     
     """ Estimate pose (core function) """
-    def compute_pose(self, pose_estimate, pts_occ_local, ftol=1e-3, max_nfev=15):
-        self.flag = False
-
-        self.c_index_change = np.inf
-        self.c_index = None
-        self.h_occ = None
-
-        self.threshold_c_index = .05*16*pts_occ_local.shape[1]
+    def compute_pose(self, pose_estimate, pts_occ_local, ftol=1e-3, max_nfev=15, xtol=1e-8):
+        x_loc, y_loc = pts_occ_local
+        pose, cost = _pose_lm_njit(np.asarray(pose_estimate, dtype=np.float64), 
+                                   x_loc, 
+                                   y_loc, 
+                                   self.map.ctrl_pts, 
+                                   int(self.map.grid_center[0,0]), 
+                                   int(self.map.grid_center[1,0]), 
+                                   int(self.map.grid_size[0,0]), 
+                                   float(self.map.knot_space), 
+                                   1./self.logodd_max_occupied, 
+                                   ftol, 
+                                   xtol, 
+                                   max_nfev)
+        return pose, cost
 
-        res = least_squares(self.compute_cost_function, 
-                            pose_estimate,
-                            jac = self.compute_jacobian, 
-                            verbose = 0, 
-                            method='lm',
-                            loss='linear',
-                            ftol = ftol,
-                            max_nfev = max_nfev,
-                            f_scale = 1.,
-                            args=pts_occ_local )
-
-        return res.x, res.cost
+    """ Compute the residual [n] (ORDER & 0x01) and the jacobian [nx3] (ORDER & 0x02) of the occupied points in one pass """
+    def compute_residual(self, pose, pts_occ_local_x, pts_occ_local_y, ORDER=0x03):
+        nb_pts = len(pts_occ_local_x)
+        r = h_occ = []
+        r_out = np.empty(nb_pts if ORDER & 0x01 else 0)
+        h_out = np.empty([nb_pts if ORDER & 0x02 else 0, 3])
+        _residual_njit(np.asarray(pose, dtype=np.float64), 
+                       pts_occ_local_x, 
+                       pts_occ_local_y, 
+                       self.map.ctrl_pts, 
+                       int(self.map.grid_center[0,0]), 
+                       int(self.map.grid_center[1,0]), 
+                       int(self.map.grid_size[0,0]), 
+                       float(self.map.knot_space), 
+                       1./self.logodd_max_occupied, 
+                       ORDER, r_out, h_out)
+        if ORDER & 0x01:
+            r = r_out
+        if ORDER & 0x02:
+            h_occ = h_out
+        return r, h_occ
 
     def compute_jacobian(self, pose, pts_occ_local_x, pts_occ_local_y):
-        # Recompute jacobian only if change in control points is above threshold_c_index
-        if self.c_index_change < self.threshold_c_index:
-            return self.h_occ.T
-        else:
-            self.flag = False
-
-        pts_occ_local = np.vstack([pts_occ_local_x, pts_occ_local_y])
-        # Transforming occupied points to global frame
-        pts_occ = self.local_to_global_frame(pose, pts_occ_local)
-        # Spline tensor
-        c_index_occ = self.map.compute_sparse_tensor_index(pts_occ)
-        _, dBx_occ, dBy_occ = self.map.compute_tensor_spline(pts_occ, ORDER= 0x02)                
-        # Rotation matrix
-        cos, sin = np.cos(pose[2]), np.sin(pose[2])
-        R = np.array([[-sin, -cos],[cos, -sin]])           
-        # compute H and b  
-        ds_occ = np.zeros([2, len(pts_occ_local_x)])
-        ds_occ[0,:]=np.sum((self.map.ctrl_pts[c_index_occ]) *dBx_occ, axis=1)/ self.logodd_max_occupied 
-        ds_occ[1,:]=np.sum((self.map.ctrl_pts[c_index_occ]) *dBy_occ, axis=1)/ self.logodd_max_occupied
-        dpt_occ_local = R@pts_occ_local
-    
-        # Jacobian
-        h_occ = np.zeros([3, len(pts_occ_local_x)])
-        h_occ[0,:] = -ds_occ[0,:]
-        h_occ[1,:] = -ds_occ[1,:]
-        h_occ[2,:] = -np.sum(dpt_occ_local*ds_occ,axis=0)
-
-        self.h_occ = h_occ
-
-        return h_occ.T
+        _, h_occ = self.compute_residual(pose, pts_occ_local_x, pts_occ_local_y, ORDER=0x02)
+        return h_occ
 
     def compute_cost_function(self, pose, pts_occ_local_x, pts_occ_local_y):
         # computing alignment error
-        pts_occ_local = np.vstack([pts_occ_local_x, pts_occ_local_y])
-        pts_occ = self.local_to_global_frame(pose, pts_occ_local)
-        c_index_occ = self.map.compute_sparse_tensor_index(pts_occ)
-        B_occ, _, _ = self.map.compute_tensor_spline(pts_occ, ORDER=0x01)        
-        s_occ = np.sum(self.map.ctrl_pts[c_index_occ]*B_occ, axis=1) /self.logodd_max_occupied       
-        r = (1 - s_occ)
-
-        if self.flag is True:
-            self.c_index_change = np.sum(self.c_index != c_index_occ)
-        else:
-            self.c_index = c_index_occ
-            self.flag = True
-
+        r, _ = self.compute_residual(pose, pts_occ_local_x, pts_occ_local_y, ORDER=0x01)
         return r
 
     """"Occupancy grid mapping routine to update map using range measurements"""
@@ -109,21 +310,25 @@ class ScanMatching:
             pose_estimative = np.copy(self.pose)
 
         pts_occ_local = sensor.get_occupied_pts()
+        # Coarse solves use a subsampled scan, the final refinement always uses the full scan
+        pts_occ_local_subsampled = (pts_occ_local[0][::self.sensor_subsampling_factor], 
+                                    pts_occ_local[1][::self.sensor_subsampling_factor])
 
         # Scan-matching
         tic = time.clock()      
-        best_cost_estimate = np.inf
         # If odometry is poor search with different orientations
         if unreliable_odometry:
-            candidate = [0, np.pi/4., -np.pi/4., np.pi/2., -np.pi/2, -1.5*np.pi, -1.5*np.pi]
+            candidate = [0, np.pi/4., -np.pi/4., np.pi/2., -np.pi/2, np.pi]
         else:
             candidate = [0]
-        for theta in candidate:
-            pose_estimate_candidate, cost_estimate = self.compute_pose(np.array(pose_estimative) + np.array([0,0,theta]), pts_occ_local, ftol=1e-2, max_nfev=5)
-            if cost_estimate < best_cost_estimate:
-                best_cost_estimate = cost_estimate
-                best_pose_estimate = pose_estimate_candidate
-        pose_self, cost_self= self.compute_pose(self.pose, pts_occ_local, ftol = 1e-2, max_nfev=5)        
+        pose_candidates = [np.array(pose_estimative) + np.array([0,0,theta]) for theta in candidate]
+        results = [self.compute_pose(pose, pts_occ_local_subsampled, ftol=1e-2, max_nfev=5) for pose in pose_candidates]
+        best_pose_estimate, best_cost_estimate = min(results, key=lambda result: result[1])
+        # Starting from self.pose duplicates the first candidate if the estimative is the current pose
+        if np.allclose(pose_estimative, self.pose):
+            pose_self, cost_self = results[0]
+        else:
+            pose_self, cost_self = self.compute_pose(self.pose, pts_occ_local_subsampled, ftol = 1e-2, max_nfev=5)        
 
         if best_cost_estimate < cost_self:
            self.pose, _ = self.compute_pose(best_pose_estimate, pts_occ_local)
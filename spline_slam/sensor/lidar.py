@@ -1,4 +1,17 @@
 import numpy as np
+from numba import njit
+
+""" Sample the free space along the selected beams: beam k emits beam_samples[0:offsets[k+1]-offsets[k]]
+    at pts_free[:, offsets[k]:offsets[k+1]]
+"""
+@njit(cache=True)
+def _free_space_njit(index, cos_angles, sin_angles, beam_samples, offsets, pts_free):
+    for k in range(index.size):
+        c, s = cos_angles[index[k]], sin_angles[index[k]]
+        o = offsets[k]
+        for j in range(offsets[k+1] - o):
+            pts_free[0, o+j] = beam_samples[j]*c
+            pts_free[1, o+j] = beam_samples[j]*s
 
 class Lidar:
     def __init__(self, **kwargs):
@@ -19,32 +32,31 @@ class Lidar:
         self.free_samples_interval = kwargs['free_samples_interval']
  
         self.angles = np.linspace(self.angle_min, self.angle_max, self.number_beams)
-        self.beam_samples = np.arange(self.range_min, self.range_max, self.free_samples_interval).reshape([-1,1])       
-
-        # Storing beam samples in memory for speed up 
-        self.beam_matrix_x = self.beam_samples.reshape(-1,1) * np.cos(self.angles)
-        self.beam_matrix_y = self.beam_samples.reshape(-1,1) * np.sin(self.angles)    
+        self.cos_angles = np.cos(self.angles)
+        self.sin_angles = np.sin(self.angles)
+        self.beam_samples = np.arange(self.range_min, self.range_max, self.free_samples_interval)
 
     def process_new_measurements(self, ranges, **kwargs):
-        occupied_ranges, occupied_angles = self.filter_occupied_ranges(ranges)              
-        self.occupied_pts = self.range_to_coordinate(occupied_ranges, occupied_angles)
+        occupied_ranges, occupied_index = self.filter_occupied_ranges(ranges)              
+        self.occupied_pts = self.range_to_coordinate(occupied_ranges, occupied_index)
         self.free_pts = self.compute_free_space(ranges)
 
     def filter_occupied_ranges(self, ranges):
         index = np.logical_and(ranges >= self.range_min, ranges < self.range_max)
         occupied_ranges = ranges[index]
-        occupied_angles = self.angles[index]
-        return occupied_ranges, occupied_angles
+        return occupied_ranges, index
 
-    def range_to_coordinate(self, ranges, angles):
-        direction = np.array([np.cos(angles), np.sin(angles)]) 
-        return  ranges * direction
+    """ Returns the (x, y) coordinates of the beams selected by index as two contiguous 1D arrays """
+    def range_to_coordinate(self, ranges, index):
+        return ranges * self.cos_angles[index], ranges * self.sin_angles[index]
 
     def compute_free_space(self, ranges):      
         index_free =  np.where((ranges >= self.range_min) & (ranges  <= self.range_max))[0]
-        index_free_matrix = self.beam_samples  < (ranges[index_free]).reshape([1,-1])
-        pts_free = np.vstack([self.beam_matrix_x[:, index_free][index_free_matrix],
-                              self.beam_matrix_y[:, index_free][index_free_matrix]])    
+        # Number of beam samples before the hit of each beam (beam_samples is sorted)
+        nb_free = np.searchsorted(self.beam_samples, ranges[index_free], side='left')
+        offsets = np.concatenate([[0], np.cumsum(nb_free)])
+        pts_free = np.empty([2, offsets[-1]])
+        _free_space_njit(index_free, self.cos_angles, self.sin_angles, self.beam_samples, offsets, pts_free)
         if pts_free.size == 0:
             pts_free = np.zeros([2,1])
 